@@ -1,6 +1,11 @@
-from .main import GeminiWrapper
-
 import os
 if os.path.exists(".env"):
     from dotenv import load_dotenv
-    load_dotenv()
\ No newline at end of file
+    load_dotenv()
+
+def __getattr__(name):
+    # Deferred so importing gemiwrap.utils doesn't pull in the genai SDK
+    if name == "GeminiWrapper":
+        from .main import GeminiWrapper
+        return GeminiWrapper
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
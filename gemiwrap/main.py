@@ -1,6 +1,9 @@
-from .utils import compress_image, compress_video, split_video
+from .utils import compress_image_bytes, compress_video, iter_split_video, validate_video_tokens, get_mime_type
 from custom_logger import logger_config
+import io
 import os
+import time
+import collections
 import concurrent.futures
 from google import genai
 from google.genai import types
@@ -16,8 +19,14 @@ class GeminiWrapper:
 		self.tools = tools
 		self.thinking_config = thinking_config
 
-		self.used_keys = set()
+		# Parsed once; rotating the ring hands out keys round-robin
+		self._key_ring = collections.deque(key.strip() for key in os.getenv("GEMINI_API_KEYS", "").split(",") if key.strip())
+		if not self._key_ring:
+			raise ValueError("No Gemini API keys available")
 		self.current_key = None
+		self._clients = {}
+		# Shared across calls; extra workers keep a timed out request from blocking the next one
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="gemi-send")
 
 		self.__initialize_api(self.history)
 
@@ -27,8 +36,11 @@ class GeminiWrapper:
 	def __initialize_api(self, history=None):
 		try:
 			self.__set_new_current_key()
-			self.client = genai.Client(api_key=self.current_key)
-			self.chat = self.client.chats.create(model=self._model_name, history=history)
+			# One client per key keeps its HTTP connection pool warm across rotations
+			if self.current_key not in self._clients:
+				self._clients[self.current_key] = genai.Client(api_key=self.current_key)
+			self.client = self._clients[self.current_key]
+			self.__start_chat(history)
 
 			logger_config.debug(f"system_instruction:: {self.system_instruction}")
 			logger_config.debug(f"history:: {self.history}")
@@ -37,47 +49,75 @@ class GeminiWrapper:
 			logger_config.error(f"API initialization failed: {e}")
 			raise
 
-	def __set_new_current_key(self):
-		keys = os.getenv("GEMINI_API_KEYS", "").split(",")
-		keys = [key.strip() for key in keys if key.strip()]
-		
-		if not keys:
-			raise ValueError("No Gemini API keys available")
-
-		for key in keys:
-			if key not in self.used_keys:
-				self.current_key = key
-				self.used_keys.add(key)
-				return
+	def __start_chat(self, history=None):
+		self.chat = self.client.chats.create(model=self._model_name, history=history)
 
-		self.used_keys.clear()
-		self.current_key = keys[0]
-		self.used_keys.add(self.current_key)
+	def __set_new_current_key(self):
+		self.current_key = self._key_ring[0]
+		self._key_ring.rotate(-1)
 
 	def __upload_to_gemini(self, path):
-		logger_config.debug(f"Uploading file '{path}'")
-		file = self.client.files.upload(file=str(path))
+		if isinstance(path, bytes):
+			# Compressed image held in memory
+			logger_config.debug(f"Uploading {len(path)} bytes of JPEG")
+			file = self.client.files.upload(file=io.BytesIO(path), config=types.UploadFileConfig(mime_type="image/jpeg"))
+		else:
+			logger_config.debug(f"Uploading file '{path}'")
+			file = self.client.files.upload(file=str(path), config=types.UploadFileConfig(mime_type=get_mime_type(path)))
 		logger_config.debug(f"Uploaded file '{file.display_name}' as: {file.uri}")
 		return file
 
-	def __delete_file_paths(self):
+	def __prepare_file(self, path):
+		file = self.__upload_to_gemini(path)
+		self.__wait_for_files_active([file])
+		return file
+
+	def __delete_file(self, file):
 		try:
-			for file in self.client.files.list():
-				self.client.files.delete(name=file.name)
-				logger_config.success(f"Deleted file '{file.name}'")
+			self.client.files.delete(name=file.name)
+			logger_config.success(f"Deleted file '{file.name}'")
 		except:
 			pass
 
-	def __wait_for_files_active(self, files):
-		logger_config.debug("Waiting for file processing...")
-		for name in (file.name for file in files):
+	def __delete_file_paths(self):
+		try:
+			files = list(self.client.files.list())
+		except:
+			return
+
+		# __delete_file swallows its own errors, so one failure doesn't stop the batch
+		with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+			list(executor.map(self.__delete_file, files))
+
+	def __wait_for_file_active(self, name):
+		delay = 1
+		file = self.client.files.get(name=name)
+		while file.state.name == "PROCESSING":
+			time.sleep(delay)
+			delay = min(delay * 2, 10)
 			file = self.client.files.get(name=name)
-			while file.state.name == "PROCESSING":
-				logger_config.debug("", seconds=10)
-				file = self.client.files.get(name=name)
 
-			if file.state.name != "ACTIVE":
-				raise Exception(f"File {file.name} failed to process")
+		if file.state.name != "ACTIVE":
+			raise Exception(f"File {file.name} failed to process")
+
+	def __wait_for_files_active(self, files):
+		logger_config.debug("Waiting for file processing...")
+		names = [file.name for file in files]
+		if len(names) == 1:
+			# The common single upload doesn't need a pool
+			self.__wait_for_file_active(names[0])
+			logger_config.success("...all files ready")
+			return
+
+		executor =concurrent.futures.ThreadPoolExecutor(max_workers=max(len(names), 1))
+		futures = [executor.submit(self.__wait_for_file_active, name) for name in names]
+		done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+		for future in done:
+			if future.exception():
+				# Not using context manager so a failed file doesn't wait on the others
+				executor.shutdown(wait=False, cancel_futures=True)
+				raise future.exception()
+		executor.shutdown()
 
 		logger_config.success("...all files ready")
 
@@ -113,16 +153,35 @@ class GeminiWrapper:
 		)
 
 	def __send_message_with_timeout(self, user_prompt, config, timeout=300):
-		executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-		future = executor.submit(lambda: self.chat.send_message(user_prompt, config))
+		future = self._executor.submit(self.chat.send_message, user_prompt, config)
 		try:
 			return future.result(timeout=timeout)
 		except concurrent.futures.TimeoutError:
 			logger_config.error("Request timed out")
-			# Not using context manager so we can shut down more aggressively
-			executor.shutdown(wait=False)
+			future.cancel()
 			return None
 
+	def __compress_part(self, path, threads=0):
+		# Encode next to the raw split part, in the split's directory, then drop the raw part
+		# unless compress_video handed it back unchanged
+		path = str(path)
+		output_path = str(compress_video(path, f"{os.path.splitext(path)[0]}_compressed.mp4", threads=threads))
+		if output_path != path:
+			os.remove(path)
+		return output_path
+
+	def __compress_parts(self, parts, count):
+		if count == 1:
+			# Not split: the one "part" is the caller's own file, so it must be kept
+			return [str(compress_video(path)) for path, _ in parts]
+
+		cpu_count = os.cpu_count() or 1
+		workers = min(count, max(cpu_count // 2, 1))
+		threads = max(cpu_count // workers, 1)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = [executor.submit(self.__compress_part, path, threads) for path, _ in parts]
+			return [future.result() for future in futures]
+
 	def send_message(self, user_prompt="", file_path=None, system_instruction=None, schema=None, response_mime_type=None, compress=True):
 		if not user_prompt:
 			user_prompt = ""
@@ -141,63 +200,102 @@ class GeminiWrapper:
 
 		if file_path and compress:
 			if file_path.endswith((".jpg", ".png", ".jpeg")):
-				file_paths = [str(compress_image(file_path))]
+				# Upload straight from memory, no temp JPEG on disk
+				file_paths = [compress_image_bytes(file_path)]
 			elif file_path.endswith((".mp4", ".mkv", ".avi", ".mov")):
-				file_path = compress_video(file_path)
-				file_paths, _ = split_video(file_path)
-				file_paths = [str(p) for p in file_paths]
+				parts = validate_video_tokens(file_path)
+				if parts > 1 and (os.cpu_count() or 1) // 2 <= 1:
+					# Parts would encode one at a time anyway; encode and cut in a single ffmpeg run
+					file_paths = [str(p) for p, _ in iter_split_video(file_path, compress=True)]
+				else:
+					# Stream-copy split first, then encode each part as soon as it is cut
+					file_paths = self.__compress_parts(iter_split_video(file_path), max(parts, 1))
 			else:
 				file_paths = [file_path]
 
 		index = 0
 		unavaiable_retry_done = False
 		model_responses = []
-		while True:
-			file = file_paths[index]
-			try:
-				if not self.chat or len(file_paths) > 1:
-					logger_config.info("Starting a new chat session.")
-					self.__initialize_api()
+		# Upload + activation of the next part overlaps the current send
+		uploader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		uploads = {}
+		try:
+			if len(file_paths) > 1:
+				self.__delete_file_paths()
+
+			while True:
+				file = file_paths[index]
+				try:
+					if not self.chat:
+						logger_config.info("Starting a new chat session.")
+						self.__initialize_api()
+					elif len(file_paths) > 1:
+						logger_config.info("Starting a new chat session.")
+						self.__start_chat()
+
 					if len(file_paths) > 1:
-						self.__delete_file_paths()
-
-				if len(file_paths) > 1:
-					user_prompt = f'{original_text} Part {index+1} of {len(file_paths)}'
-					if len(model_responses) > 0:
-						user_prompt += f'\nprevious output: {model_responses[-1]}'
-
-				logger_config.debug(f"user_prompt: {user_prompt}")
-				uploaded_file = None
-				if file:
-					uploaded_file = self.__upload_to_gemini(file)
-					self.__wait_for_files_active([uploaded_file])
-
-				response = self.__send_message_with_timeout([user_prompt, uploaded_file] if uploaded_file else [user_prompt], self.__get_config())
-				result = response.text
-				if result is None:
-					raise ValueError("None returned.")
-
-				model_responses.append(result)
-				logger_config.debug(f"Google AI studio response: {result}")
-				index += 1
-				unavaiable_retry_done = False
-
-				if not file or index >= len(file_paths):
-					break
-
-			except Exception as e:
-				error_message = str(e)
-				if "RESOURCE_EXHAUSTED" in error_message:
-					logger_config.warning("Quota exceeded, switching API key...")
-					self.__initialize_api()
-				elif not unavaiable_retry_done:
-					unavaiable_retry_done = True
-					logger_config.warning("Service unavailable, waiting for 50 seconds before retrying...", seconds=50)
-				else:
-					raise
+						user_prompt = f'{original_text} Part {index+1} of {len(file_paths)}'
+						if len(model_responses) > 0:
+							user_prompt += f'\nprevious output: {model_responses[-1]}'
+
+					logger_config.debug(f"user_prompt: {user_prompt}")
+					uploaded_file = None
+					if file:
+						if index not in uploads:
+							uploads[index] = uploader.submit(self.__prepare_file, file)
+						if index + 1 < len(file_paths) and index + 1 not in uploads:
+							uploads[index + 1] = uploader.submit(self.__prepare_file, file_paths[index + 1])
+						uploaded_file = uploads[index].result()
+
+					response = self.__send_message_with_timeout([user_prompt, uploaded_file] if uploaded_file else [user_prompt], self.__get_config())
+					result = response.text
+					if result is None:
+						raise ValueError("None returned.")
+
+					model_responses.append(result)
+					logger_config.debug(f"Google AI studio response: {result}")
+					if len(file_paths) > 1:
+						self.__delete_file(uploads.pop(index).result())
+					index += 1
+					unavaiable_retry_done = False
+
+					if not file or index >= len(file_paths):
+						break
+
+				except Exception as e:
+					# A failed upload is retried from scratch
+					failed = uploads.get(index)
+					if failed is not None and failed.done() and failed.exception():
+						uploads.pop(index)
+
+					error_message = str(e)
+					if "RESOURCE_EXHAUSTED" in error_message:
+						logger_config.warning("Quota exceeded, switching API key...")
+						# Files belong to the old key: let an in-flight prefetch finish and
+						# delete what was uploaded with the old client, then upload them again
+						for upload in uploads.values():
+							if not upload.cancel() and upload.exception() is None:
+								self.__delete_file(upload.result())
+						uploads.clear()
+						self.__initialize_api()
+					elif not unavaiable_retry_done:
+						unavaiable_retry_done = True
+						logger_config.warning("Service unavailable, waiting for 50 seconds before retrying...", seconds=50)
+					else:
+						raise
+		finally:
+			uploader.shutdown(wait=False, cancel_futures=True)
 
 		return model_responses
 
+	def close(self):
+		self._executor.shutdown(wait=False, cancel_futures=True)
+
+	def __del__(self):
+		executor = getattr(self, "_executor", None)
+		if executor:
+			executor.shutdown(wait=False)
+
 	def get_history(self):
 		return self.chat.get_history()
 
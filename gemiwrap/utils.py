@@ -1,61 +1,311 @@
 import os
-import string
 import secrets
-import ffmpeg
-import mimetypes
 import subprocess
 from pathlib import Path
 from custom_logger import logger_config
-import math
+from PIL import Image
+import functools
+import struct
+import hashlib
+import json
+import tempfile
+import contextlib
+import asyncio
+import shutil
+import io
+from stat import S_ISREG
+
+TARGET_WIDTH = 480
+TARGET_HEIGHT = 270
+HW_ENCODERS = ("h264_videotoolbox", "h264_nvenc", "h264_qsv", "h264_vaapi")
+VIDEO_EXTS = frozenset({'.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi', '.flv', '.wmv', '.mpeg', '.mpg', '.ts', '.3gp'})
+REMUX_MAX_BITRATE = 96000
+PASSTHROUGH_MAX_MB = 20
+PASSTHROUGH_MAX_FPS = 5
+X264_PRESET = os.getenv("GEMIWRAP_X264_PRESET", "veryfast")
+FFMPEG_DEBUG = os.getenv("GEMIWRAP_FFMPEG_DEBUG") == "1"
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+MIME_BY_EXT = {
+    '.mp4': 'video/mp4',
+    '.mkv': 'video/x-matroska',
+    '.mov': 'video/quicktime',
+    '.avi': 'video/x-msvideo',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+}
+
+_MADE_DIRS = set()
+# Hardware encoders that failed a real encode this process
+_FAILED_HW_ENCODERS = set()
+
+def _ensure_dir(path):
+    # Remember directories already created this process to skip the stat/mkdir
+    path = str(path)
+    if path not in _MADE_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _MADE_DIRS.add(path)
 
 def generate_random_string(length=10):
-    characters = string.ascii_letters
-    random_string = ''.join(secrets.choice(characters) for _ in range(length))
-    return random_string
+    # One os.urandom call, already filename safe; only used as a salt
+    return secrets.token_hex((length + 1) // 2)[:length]
+
+def get_mime_type(file_path):
+    # Common extensions skip the mimetypes database entirely
+    ext = os.path.splitext(str(file_path))[1].lower()
+    mime_type = MIME_BY_EXT.get(ext)
+    if mime_type is None:
+        import mimetypes
+        mime_type, _ = mimetypes.guess_type(str(file_path))
+    return mime_type or "application/octet-stream"
 
 def is_video_file(file_path):
-    mime_type, _ = mimetypes.guess_type(file_path)
-    return mime_type and mime_type.startswith("video")
+    if os.path.splitext(str(file_path))[1].lower() in VIDEO_EXTS:
+        return True
+    return get_mime_type(file_path).startswith("video")
+
+@functools.lru_cache(maxsize=128)
+def _probe(path, mtime, size):
+    cmd = ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", path]
+    return json.loads(subprocess.run(cmd, capture_output=True, check=True).stdout)
+
+def probe_video(file_path):
+    # Keyed on mtime/size so a rewritten file is probed again
+    file_stat = os.stat(file_path)
+    return _probe(str(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+def _read_box_header(f):
+    header = f.read(8)
+    if len(header) < 8:
+        return None, None, None
+    size, box_type = struct.unpack(">I4s", header)
+    header_size = 8
+    if size == 1:
+        size = struct.unpack(">Q", f.read(8))[0]
+        header_size = 16
+    elif size == 0:
+        # Box runs to the end of the file
+        current = f.tell()
+        size = f.seek(0, os.SEEK_END) - current + header_size
+        f.seek(current)
+    return box_type, size, header_size
+
+def _mp4_duration(f):
+    # moov/mvhd holds timescale + duration; moov may sit after mdat, so seek past boxes
+    end = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    parent_end = end
+    while f.tell() < parent_end:
+        start = f.tell()
+        box_type, size, header_size = _read_box_header(f)
+        if box_type is None or size < header_size:
+            return None
+        if box_type == b"moov":
+            parent_end = start + size
+            continue
+        if box_type == b"mvhd":
+            version = f.read(4)[0]
+            if version == 1:
+                f.seek(16, os.SEEK_CUR)
+                timescale, duration = struct.unpack(">IQ", f.read(12))
+                unknown = 0xFFFFFFFFFFFFFFFF
+            else:
+                f.seek(8, os.SEEK_CUR)
+                timescale, duration = struct.unpack(">II", f.read(8))
+                unknown = 0xFFFFFFFF
+            # All ones marks an unknown duration (e.g. fragmented files), let ffprobe decide
+            if not timescale or duration == unknown:
+                return None
+            return duration / timescale
+        f.seek(start + size)
+    return None
+
+def _read_vint(f, keep_marker=False):
+    first = f.read(1)
+    if not first:
+        return None
+    first = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        return None
+    value = first if keep_marker else first & (mask - 1)
+    for byte in f.read(length - 1):
+        value = (value << 8) | byte
+    return value
+
+def _mkv_duration(f):
+    # Segment > Info > TimecodeScale / Duration, stop once clusters start
+    f.seek(0)
+    if _read_vint(f, keep_marker=True) != 0x1A45DFA3:
+        return None
+    header_size = _read_vint(f)
+    if header_size is None:
+        return None
+    f.seek(header_size, os.SEEK_CUR)
+    if _read_vint(f, keep_marker=True) != 0x18538067:
+        return None
+    _read_vint(f)
+
+    while True:
+        element_id = _read_vint(f, keep_marker=True)
+        size = _read_vint(f)
+        if element_id is None or size is None or element_id == 0x1F43B675:
+            return None
+        if element_id != 0x1549A966:
+            f.seek(size, os.SEEK_CUR)
+            continue
+
+        info_end = f.tell() + size
+        timecode_scale = 1000000
+        duration = None
+        while f.tell() < info_end:
+            child_id = _read_vint(f, keep_marker=True)
+            child_size = _read_vint(f)
+            if child_id is None or child_size is None:
+                return None
+            data = f.read(child_size)
+            if child_id == 0x2AD7B1:
+                timecode_scale = int.from_bytes(data, "big")
+            elif child_id == 0x4489:
+                duration = struct.unpack(">f" if child_size == 4 else ">d", data)[0]
+        return duration * timecode_scale / 1e9 if duration is not None else None
+
+def _fast_duration(file_path):
+    """
+    Read the duration straight from the MP4/MOV (mvhd) or MKV/WebM (Segment Info)
+    header. Returns None when the container is not handled or cannot be parsed.
+    """
+    ext = Path(file_path).suffix.lower()
+    try:
+        with open(file_path, "rb") as f:
+            if ext in (".mp4", ".mov", ".m4v"):
+                return _mp4_duration(f)
+            if ext in (".mkv", ".webm"):
+                return _mkv_duration(f)
+    except (OSError, struct.error, IndexError, ValueError):
+        pass
+    return None
 
 def video_duration(file_path):
-	if not os.path.isfile(file_path) or not is_video_file(file_path):
+	# A single stat both checks the file and keys the cache
+	try:
+		file_stat = os.stat(file_path)
+	except OSError:
 		return 0
+	if not S_ISREG(file_stat.st_mode) or not is_video_file(file_path):
+		return 0
+
+	return _video_duration(str(file_path), file_stat.st_mtime_ns, file_stat.st_size)
 
-	probe = ffmpeg.probe(file_path)
-	duration = int(float(probe['format']['duration'])) # seconds
-	return duration
+@functools.lru_cache(maxsize=256)
+def _video_duration(file_path, mtime, size):
+	duration = _fast_duration(file_path)
+	if duration:
+		return int(duration) # seconds
 
-def split_video(video_path):
+	# Same cached probe get_video_info uses, so compress_video doesn't run ffprobe twice
+	duration = _probe(file_path, mtime, size).get("format", {}).get("duration")
+	try:
+		return int(float(duration)) # seconds
+	except (TypeError, ValueError):
+		# Missing or "N/A"
+		return 0
+
+def get_video_info(file_path):
+    """
+    Width, height and frame rate of the first video stream, or (None, None, None) if there is none.
+    """
+    probe = probe_video(file_path)
+    for stream in probe.get('streams', []):
+        if stream.get('codec_type') == 'video':
+            num, _, den = stream.get('avg_frame_rate', '0/1').partition('/')
+            fps = int(num) / int(den) if den and int(den) else None
+            return int(stream['width']), int(stream['height']), fps
+    return None, None, None
+
+def _read_split_manifest(manifest_path, existing):
+    # Only trusted when every listed part is still on disk and non-empty;
+    # existing is a {name: DirEntry} snapshot of the directory
+    if manifest_path.name not in existing:
+        return None
+    try:
+        entries = json.loads(manifest_path.read_text())
+    except ValueError:
+        return None
+
+    if not entries or not all(entry[0] in existing and existing[entry[0]].stat().st_size > 0 for entry in entries):
+        return None
+    return [manifest_path.parent / entry[0] for entry in entries], [(entry[1], entry[2]) for entry in entries]
+
+def split_video(video_path, compress=False, target_size_mb=None):
     """
     Split a video file into multiple parts based on token validation, using fast subclip extraction.
     
     Args:
         video_path: Path to the input video file
+        compress: Encode for Gemini in the same ffmpeg run instead of stream copying
+        target_size_mb: With compress, a per-part size budget. Enables a 2-pass encode
+            whose first pass covers the whole file, so every part shares one rate plan
         
     Returns:
         Tuple[List[Path], List[Tuple[float, float]]]:
             - List of paths to successfully created video parts
-            - List of (start_sec, end_sec) ranges
+            - List of (start_sec, end_sec) ranges. Exact for compressed parts; stream
+              copied parts start at the first keyframe at or after start_sec
+    """
+    all_files = []
+    time_ranges = []
+    for output_path, time_range in iter_split_video(video_path, compress, target_size_mb):
+        all_files.append(output_path)
+        time_ranges.append(time_range)
+    return all_files, time_ranges
+
+def iter_split_video(video_path, compress=False, target_size_mb=None):
     """
-    parts = validate_video_tokens(video_path)
+    Generator form of split_video: yields (part_path, (start_sec, end_sec)) as each
+    part is written, so callers can start on part 1 while later parts are still cut.
+
+    Encoded parts are cut exactly on the returned ranges (keyframes are forced there).
+    Stream copied parts can only be cut on existing keyframes, so each one really
+    starts at the first keyframe at or after its start_sec; the ranges are nominal.
+    """
+    duration = video_duration(video_path)
+    parts = validate_video_tokens(video_path, duration)
     if parts == -1:
-        duration = video_duration(video_path)
-        return [video_path], [(0, duration if duration else None)]
+        yield compress_video(video_path, target_size_mb=target_size_mb) if compress else video_path, (0, duration if duration else None)
+        return
 
     logger_config.info(f"Attempting to split video: {video_path} into {parts} parts.")
     
     path = Path(video_path)
     name = path.stem
-    ext = path.suffix
+    # Encoded parts are always mp4, copied parts keep the input container
+    ext = ".mp4" if compress else path.suffix
     all_files = []
     time_ranges = []
     temp_dir = Path(os.getenv("TEMP_OUTPUT", "reuse")) / name
-    temp_dir.mkdir(parents=True, exist_ok=True)
+    _ensure_dir(temp_dir)
 
-    duration = video_duration(video_path)
     if duration is None or duration <= 0:
         logger_config.error("Could not determine video duration or duration is zero.")
-        return [], []
+        return
+
+    # Parts are keyed on the exact input version so a re-run is a manifest read
+    stat = os.stat(video_path)
+    split_key = hashlib.blake2b(f"{path.resolve()}|{stat.st_mtime_ns}|{stat.st_size}|{parts}|{compress}|{target_size_mb}".encode(), digest_size=8).hexdigest()
+    manifest_path = temp_dir / f"{name}_{split_key}.manifest.json"
+    # One directory read instead of an exists()/stat() per part
+    with os.scandir(temp_dir) as entries:
+        existing = {entry.name: entry for entry in entries}
+    cached = _read_split_manifest(manifest_path, existing)
+    if cached:
+        logger_config.info(f"All {len(cached[0])} parts already exist, skipping split.")
+        yield from zip(*cached)
+        return
 
     each_dur = int(duration / parts)
     logger_config.info(f"Total duration: {duration}s. Each part approx: {each_dur}s")
@@ -63,77 +313,381 @@ def split_video(video_path):
     for i in range(parts):
         start_sec = int(i * each_dur)
         end_sec = int(duration if i == parts - 1 else (i + 1) * each_dur)
+        all_files.append(temp_dir / f"{name}_{split_key}_{start_sec}_{end_sec}{ext}")
+        time_ranges.append((start_sec, end_sec))
 
-        output_filename = f"{name}_{start_sec}_{end_sec}.mp4"
-        output_path = temp_dir / output_filename
+    # One ffmpeg run with the segment muxer reads the input once and writes
+    # every part, instead of one seek + demux per part.
+    # Keyed like the parts, so another split of a same-named file keeps its segments
+    segment_prefix = f"{name}_{split_key}_segment_"
+    segment_pattern = temp_dir / f"{segment_prefix}%03d{ext}"
+    for entry_name, entry in existing.items():
+        if entry_name.startswith(segment_prefix) and entry_name.endswith(ext):
+            os.unlink(entry.path)
 
-        # Skip if file already exists
-        if output_path.exists():
-            logger_config.info(f"Part {i+1} already exists, skipping: {output_path}")
-            all_files.append(output_path)
-            time_ranges.append((start_sec, end_sec))
-            continue
+    cmd = ["ffmpeg", "-y"]
 
-        # Build ffmpeg command for fast subclip (no re-encoding)
-        cmd = ["ffmpeg", "-y"]  # -y to overwrite existing files
-
-        # CRITICAL FIX: Put -ss BEFORE -i for accurate seeking
-        if start_sec > 0:
-            cmd += ["-ss", f"{start_sec}"]
-        
-        # Input file first
+    logfile = None
+    if compress:
+        # One decode + encode for every part; keyframes forced on the cut points
+        key_frames = ["-force_key_frames", ",".join(str(start) for start, _ in time_ranges[1:])]
+        cmd += ["-hwaccel", "auto", "-i", str(video_path)]
+        video_map = ["-map", "0:v:0"]
+        cmd += [*video_map, "-map", "0:a:0?"]
+        if target_size_mb:
+            # Whole-file first pass, so parts get consistent quality from one set of stats;
+            # it must analyse the same video stream pass 2 encodes
+            bitrate = calculate_bitrate(video_path, target_size_mb * parts)
+            logfile = temp_dir / f"{name}_{split_key}_passlog"
+            if _run_pass1(video_path, bitrate, logfile, extra_args=[*video_map, *key_frames]).returncode != 0:
+                _remove_pass_logs(logfile)
+                raise ValueError("First pass failed")
+            cmd += ["-c:v", "libx264", "-b:v", f"{bitrate}k", "-preset", "slow", "-pass", "2", "-passlogfile", str(logfile)]
+        else:
+            cmd += ["-c:v", "libx264", "-crf", "32", "-preset", X264_PRESET, "-tune", "fastdecode"]
+        cmd += [*_video_args(), *_AUDIO_ARGS, *key_frames]
+    else:
         cmd += ["-i", str(video_path)]
-        
-        # Duration instead of end time for more reliable results
-        duration_part = end_sec - start_sec
-        cmd += ["-t", f"{duration_part}"]
-        
-        # Copy streams without re-encoding for speed
-        cmd += ["-c", "copy"]
-        
-        # Avoid negative timestamps and other issues
-        cmd += ["-avoid_negative_ts", "make_zero"]
-        
-        # Output file
-        cmd += [str(output_path)]
 
-        logger_config.success(f"Command to run: {cmd}")
+        # Copy streams without re-encoding for speed. Data tracks (GoPro gpmd/tmcd,
+        # iPhone mebx) have no tag in the output muxer, so drop them
+        cmd += ["-map", "0", "-dn", "-ignore_unknown", "-c", "copy"]
 
-        # Run ffmpeg
-        subprocess.run(cmd, check=True)
-        logger_config.success(f"Successfully created Part {i+1} :: {output_path}")
+    # Cut at the part boundaries (the next keyframe when copying), each part starting from timestamp zero
+    cmd += ["-f", "segment", "-segment_times", ",".join(str(start) for start, _ in time_ranges[1:])]
+    cmd += ["-reset_timestamps", "1", "-avoid_negative_ts", "make_zero"]
 
-        all_files.append(output_path)
-        time_ranges.append((start_sec, end_sec))
+    # moov at the front of every part so Gemini can start processing on upload
+    if ext.lower() in (".mp4", ".mov", ".m4v"):
+        cmd += ["-segment_format_options", "movflags=+faststart"]
 
-    return all_files, time_ranges
+    # ffmpeg prints each finished segment's name on stdout
+    cmd += ["-segment_list", "pipe:1", "-segment_list_type", "flat"]
+
+    # Output pattern
+    cmd += [str(segment_pattern)]
+
+    logger_config.success(f"Command to run: {cmd}")
+
+    produced = []
+
+    def finish(segment_name):
+        output_path = all_files[len(produced)]
+        (temp_dir / segment_name).replace(output_path)
+        produced.append((output_path, time_ranges[len(produced)]))
+        logger_config.success(f"Successfully created Part {len(produced)} :: {output_path}")
+        return produced[-1]
+
+    # ffmpeg lists a segment before closing it, so part N is only moved once entry
+    # N+1 arrives or ffmpeg exits. Holding the last one back also lets it run to the
+    # end if ffmpeg makes fewer parts than asked.
+    pending = None
+    try:
+        # Debug mode inherits stderr so ffmpeg logs to the terminal, as in run_ffmpeg
+        with contextlib.nullcontext() if FFMPEG_DEBUG else tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(_ffmpeg_argv(cmd), stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+            try:
+                for line in process.stdout:
+                    if not line.strip() or len(produced) + (pending is not None) >= parts:
+                        continue
+                    if pending:
+                        yield finish(pending)
+                    pending = Path(line.strip()).name
+                process.wait()
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+            if process.returncode != 0:
+                stderr = None
+                if stderr_file:
+                    stderr_file.seek(0)
+                    stderr = stderr_file.read()
+                raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+    finally:
+        if logfile:
+            _remove_pass_logs(logfile)
 
-def compress_image(input_path):
+    if pending:
+        finish(pending)
+
+    if len(produced) != parts:
+        logger_config.warning(f"Expected {parts} parts but ffmpeg produced {len(produced)}.")
+        if produced:
+            produced[-1] = (produced[-1][0], (produced[-1][1][0], duration))
+
+    manifest_path.write_text(json.dumps([[p.name, start, end] for p, (start, end) in produced]))
+
+    if pending:
+        yield produced[-1]
+
+def _encode_with_cjpeg(image, quality):
+    # mozjpeg's cjpeg reads PPM on stdin; returns None so the caller can fall back to Pillow
+    if not shutil.which("cjpeg"):
+        return None
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    ppm = io.BytesIO()
+    image.save(ppm, "PPM")
+    process = subprocess.run(["cjpeg", "-quality", str(quality), "-progressive", "-optimize"], input=ppm.getvalue(), capture_output=True)
+    return process.stdout if process.returncode == 0 else None
+
+def compress_image_bytes(input_path, max_dim=2048, quality=80):
+    """
+    Compressed JPEG bytes for input_path, without touching the disk.
+    """
     logger_config.info("Compressing Image")
-    temp_dir = os.getenv("TEMP_OUTPUT", "reuse")
-    os.makedirs(temp_dir, exist_ok=True)
-    name, ext = os.path.splitext(os.path.basename(input_path))
-    output_filename = f'{generate_random_string()}_compress_image_{name}{ext}'
-    output_path = os.path.join(temp_dir, output_filename)
-    from PIL import Image
     image = Image.open(input_path)
 
+    # Let libjpeg downscale in the DCT domain while decoding (no-op for other formats)
+    image.draft('RGB', (max_dim, max_dim))
+
     # Convert RGBA to RGB if necessary
     if image.mode == "RGBA":
         image = image.convert("RGB")
 
-    # Remove EXIF metadata if present
+    # Cap the longest side; thumbnail keeps the aspect ratio
+    if max(image.size) > max_dim:
+        image.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+
+    # Remove EXIF metadata if present, in the same pass as the encode
     if "exif" in image.info:
         logger_config.info("EXIF metadata found and removed.")
-        image.save(output_path, "JPEG", optimize=True, progressive=True)
-        import piexif
-        piexif.remove(output_path)
-    else:
-        image.save(output_path, "JPEG", optimize=True, progressive=True)
+    if os.getenv("MOZJPEG") == "1":
+        data = _encode_with_cjpeg(image, quality)
+        if data:
+            return data
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True, exif=b"")
+    return buffer.getvalue()
+
+def compress_image(input_path, max_dim=2048, quality=80):
+    path = Path(input_path)
+    temp_dir = Path(os.getenv("TEMP_OUTPUT", "reuse"))
+    _ensure_dir(temp_dir)
+    output_path = temp_dir / f'{generate_random_string()}_compress_image_{path.stem}{path.suffix}'
+    output_path.write_bytes(compress_image_bytes(path, max_dim, quality))
+
+    return str(output_path)
+
+def calculate_bitrate(input_path, target_size_mb, audio_bitrate_kbps=24):
+    """
+    Video bitrate (kbps) needed for the encoded file to land on target_size_mb.
+    """
+    duration = video_duration(input_path)
+    if not duration:
+        raise ValueError(f"Could not determine duration of {input_path}")
+
+    return max((int(target_size_mb * 8192) - audio_bitrate_kbps * duration) // duration, 32)
+
+def run_ffmpeg(cmd, check=False):
+    """
+    Run an ffmpeg argv quietly. Progress output is suppressed and only stderr
+    is captured, so errors can be reported from process.stderr.
+    Set GEMIWRAP_FFMPEG_DEBUG=1 to let ffmpeg log to the terminal instead.
+    """
+    if FFMPEG_DEBUG:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, text=True, check=check)
+    return subprocess.run(_ffmpeg_argv(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=check)
+
+def _ffmpeg_argv(cmd):
+    if FFMPEG_DEBUG:
+        return list(cmd)
+    return [cmd[0], "-nostats", "-loglevel", "error", *cmd[1:]]
+
+def _hw_encoder_works(encoder):
+    # Stock builds list nvenc/qsv/vaapi without a device, so encode one tiny frame
+    # with the same input and rate arguments a real encode would use
+    device_args = ["-vaapi_device", VAAPI_DEVICE] if encoder == "h264_vaapi" else []
+    upload_args = ["-vf", "format=nv12,hwupload"] if encoder == "h264_vaapi" else []
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", *device_args,
+        "-f", "lavfi", "-i", "color=s=256x144",
+        "-frames:v", "1", *upload_args,
+        "-c:v", encoder, *_hw_rate_args(encoder),
+        "-f", "null", "-"
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=30).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+@functools.lru_cache(maxsize=1)
+def detect_hw_encoder():
+    """
+    First hardware H.264 encoder this ffmpeg build offers and can actually
+    encode with, else libx264.
+    """
+    try:
+        encoders = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True).stdout.split()
+    except OSError:
+        return "libx264"
+
+    for encoder in HW_ENCODERS:
+        if encoder in encoders and _hw_encoder_works(encoder):
+            return encoder
+    return "libx264"
+
+@functools.lru_cache(maxsize=None)
+def has_ffmpeg_filter(name):
+    try:
+        filters = subprocess.run(["ffmpeg", "-hide_banner", "-filters"], capture_output=True, text=True).stdout.split()
+    except OSError:
+        return False
+    return name in filters
+
+def _cuda_pipeline(encoder):
+    # NVENC with scale_cuda keeps frames on the GPU from decode to encode
+    return encoder == "h264_nvenc" and has_ffmpeg_filter("scale_cuda")
+
+def _hw_input_args(encoder):
+    # Decode on the GPU too so frames don't cross PCIe twice
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE, "-hwaccel", "auto"]
+    if _cuda_pipeline(encoder):
+        return ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]
+    return ["-hwaccel", "auto"]
+
+def _hw_rate_args(encoder, bitrate=None):
+    if encoder == "h264_videotoolbox":
+        return ["-b:v", f"{bitrate}k", "-maxrate", f"{bitrate * 3 // 2}k"] if bitrate else ["-q:v", "65"]
+    if encoder == "h264_nvenc":
+        args = ["-preset", "p4", "-tune", "hq", "-rc", "vbr"]
+        return args + (["-b:v", f"{bitrate}k", "-maxrate", f"{bitrate * 3 // 2}k"] if bitrate else ["-cq", "32", "-b:v", "0"])
+    if encoder == "h264_qsv":
+        args = ["-preset", "slow"]
+        return args + (["-b:v", f"{bitrate}k", "-maxrate", f"{bitrate * 3 // 2}k"] if bitrate else ["-global_quality", "32"])
+    # h264_vaapi
+    if bitrate:
+        return ["-rc_mode", "VBR", "-b:v", f"{bitrate}k", "-maxrate", f"{bitrate * 3 // 2}k"]
+    return ["-rc_mode", "CQP", "-qp", "32"]
+
+# Resolution and frame rate optimized for Gemini Pro; drop frames before scaling them
+_SCALE = f"{TARGET_WIDTH}:{TARGET_HEIGHT}:force_original_aspect_ratio=decrease:force_divisible_by=2"
+_VIDEO_FILTERS = {
+    "h264_vaapi": f"fps=2,scale={_SCALE},format=nv12,hwupload",
+    "cuda": f"fps=2,scale_cuda={_SCALE}",
+}
+_DEFAULT_VIDEO_FILTER = f"fps=2,scale={_SCALE}"
+
+_AUDIO_ARGS = (
+    # Audio: Minimal but present
+    "-c:a", "aac",
+    "-b:a", "24k",                   # Very low audio bitrate
+    "-ac", "1",                      # Mono
+    "-ar", "22050",                  # Lower sample rate
+)
+
+def _video_args(encoder="libx264", threads=0):
+    video_filter = _VIDEO_FILTERS.get("cuda" if _cuda_pipeline(encoder) else encoder, _DEFAULT_VIDEO_FILTER)
+
+    # 0 lets the encoder size its thread pool to every core
+    return ["-vf", video_filter, "-threads", str(threads)]
+
+def _container_args(output_path):
+    return [
+        # Optimize for small file size and streaming
+        "-movflags", "+faststart",
+        "-avoid_negative_ts", "make_zero",
+
+        "-f", "mp4",
+        "-y", str(output_path)
+    ]
+
+def _video_bitrate(input_path):
+    # Video stream bitrate in bits/s, falling back to the container's overall rate
+    probe = probe_video(input_path)
+    for stream in probe.get('streams', []):
+        if stream.get('codec_type') == 'video' and stream.get('bit_rate'):
+            return int(stream['bit_rate'])
+    bit_rate = probe.get('format', {}).get('bit_rate')
+    return int(bit_rate) if bit_rate else None
+
+def _within_target(input_path, target_size_mb=None):
+    # Already at (or below) the Gemini resolution and inside the size budget
+    width, height, _ = get_video_info(input_path)
+    if width is None or width > TARGET_WIDTH or height > TARGET_HEIGHT:
+        return False
+    if target_size_mb:
+        return os.path.getsize(input_path) / (1024 * 1024) <= target_size_mb
+    # No size budget: only copy streams that are already about as lean as our encode
+    bitrate = _video_bitrate(input_path)
+    return bitrate is not None and bitrate <= REMUX_MAX_BITRATE
+
+def _is_gemini_ready(input_path, input_size_mb):
+    # Small, low resolution, low frame rate mp4/mov can be uploaded as is
+    if Path(input_path).suffix.lower() not in (".mp4", ".mov"):
+        return False
+    if input_size_mb >= PASSTHROUGH_MAX_MB:
+        return False
+    width, height, fps = get_video_info(input_path)
+    if width is None or fps is None:
+        return False
+    return width <= TARGET_WIDTH and height <= TARGET_HEIGHT and fps <= PASSTHROUGH_MAX_FPS
+
+def _remux(input_path, output_path):
+    # Stream copy into mp4, no transcode; only what Gemini reads, as the encode maps it
+    cmd = [
+        "ffmpeg", "-i", str(input_path),
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c", "copy",
+        *_container_args(output_path)
+    ]
+    return run_ffmpeg(cmd)
+
+def _run_pass1(input_path, bitrate, logfile, threads=0, extra_args=()):
+    # Analysis pass: only the stats file matters, so encode fast and drop audio
+    cmd = [
+        "ffmpeg", "-hwaccel", "auto", "-i", str(input_path),
+        "-c:v", "libx264",
+        "-b:v", f"{bitrate}k",
+        "-preset", "fast",
+        "-pass", "1",
+        "-passlogfile", str(logfile),
+        *_video_args(threads=threads),
+        *extra_args,
+        "-an",
+        "-f", "null",
+        "-y", os.devnull
+    ]
+    return run_ffmpeg(cmd)
+
+def _run_pass2(input_path, bitrate, logfile, output_path, threads=0):
+    cmd = [
+        "ffmpeg", "-hwaccel", "auto", "-i", str(input_path),
+        "-c:v", "libx264",
+        "-b:v", f"{bitrate}k",
+        "-preset", "slow",
+        "-pass", "2",
+        "-passlogfile", str(logfile),
+        *_video_args(threads=threads),
+        *_AUDIO_ARGS,
+        *_container_args(output_path)
+    ]
+    return run_ffmpeg(cmd)
 
-    return output_path
+def _run_hw_encode(input_path, encoder, output_path, bitrate=None, threads=0):
+    # Single pass: hardware rate control hits the bitrate without a stats pass
+    cmd = [
+        "ffmpeg",
+        *_hw_input_args(encoder),
+        "-i", str(input_path),
+        "-c:v", encoder,
+        *_hw_rate_args(encoder, bitrate),
+        *_video_args(encoder, threads),
+        *_AUDIO_ARGS,
+        *_container_args(output_path)
+    ]
+    return run_ffmpeg(cmd)
 
-def compress_video(input_path, output_path=None):
+def _remove_pass_logs(logfile):
+    for log in Path(logfile).parent.glob(f"{Path(logfile).name}*"):
+        log.unlink(missing_ok=True)
+
+def compress_video(input_path, output_path=None, target_size_mb=None, threads=0):
     """
     Simple, optimized video compression specifically for Google Gemini Pro.
     No complex settings - just compress any video to work perfectly with Gemini Pro.
@@ -147,6 +701,9 @@ def compress_video(input_path, output_path=None):
     Parameters:
     - input_path: Path to input video file
     - output_path: Optional output path (auto-generated if None)
+    - target_size_mb: Optional size budget. When set, a 2-pass bitrate encode
+      is used so the output lands on the target; otherwise constant quality (CRF)
+    - threads: Encoder threads, 0 for all cores (lower it when encoding parts in parallel)
     
     Returns:
     - Path to compressed video file
@@ -155,17 +712,18 @@ def compress_video(input_path, output_path=None):
     path = Path(input_path)
     name = path.stem
     
-    # Create output directory
+    # Default output directory; created below only once something is written to it
     temp_dir = Path(os.getenv("TEMP_OUTPUT", "reuse")) / name
-    temp_dir.mkdir(parents=True, exist_ok=True)
     
+    # Only a default destination may be satisfied by handing back the input itself
+    passthrough_ok = output_path is None
     if output_path is None:
         output_path = temp_dir / f"{name}_compressed.mp4"
     else:
         output_path = Path(output_path)
     
-    # Skip if already processed
-    if output_path.exists():
+    # Skip if already processed (an empty file is a crashed run, not a result)
+    if output_path.exists() and output_path.stat().st_size > 0:
         existing_size = os.path.getsize(output_path) / (1024 * 1024)
         print(f"Already compressed: {existing_size:.1f}MB")
         return str(output_path)
@@ -173,75 +731,126 @@ def compress_video(input_path, output_path=None):
     # Get input file size
     input_size_mb = os.path.getsize(input_path) / (1024 * 1024)
     
-    # Temporary output file
-    tmp_output = output_path.with_suffix(".tmp.mp4")
-    if tmp_output.exists():
-        tmp_output.unlink()
+    gemini_ready = not target_size_mb and _is_gemini_ready(input_path, input_size_mb)
+    if gemini_ready and passthrough_ok:
+        print(f"Already compact: {input_size_mb:.1f}MB, using input as is")
+        return str(input_path)
     
-    print(f"Compressing for Gemini Pro: {input_size_mb:.1f}MB → optimized")
+    # Temporary output file next to the final one, unique per call
+    _ensure_dir(output_path.parent)
+    with tempfile.NamedTemporaryFile(dir=output_path.parent, suffix=".tmp.mp4", delete=False) as tmp_file:
+        tmp_output = Path(tmp_file.name)
     
-    # Gemini Pro optimized FFmpeg command
-    cmd = [
-        "ffmpeg", "-i", str(input_path),
-        
-        # Video: H.264 with aggressive but readable compression
-        "-c:v", "libx264",
-        "-crf", "32",                    # Aggressive compression, still readable
-        "-preset", "veryslow",           # Best compression efficiency
-        
-        # Resolution and frame rate optimized for Gemini Pro
-        "-vf", "scale=480:270:force_original_aspect_ratio=decrease:force_divisible_by=2,fps=2",
-        
-        # Audio: Minimal but present
-        "-c:a", "aac",
-        "-b:a", "24k",                   # Very low audio bitrate
-        "-ac", "1",                      # Mono
-        "-ar", "22050",                  # Lower sample rate
-        
-        # Optimize for small file size and streaming
-        "-movflags", "+faststart",
-        "-avoid_negative_ts", "make_zero",
-        
-        # Advanced compression settings
-        "-x264-params", "keyint=120:scenecut=40:b-adapt=2:me=hex:subme=6:ref=3",
-        
-        "-f", "mp4",
-        "-y", str(tmp_output)
-    ]
+    try:
+        if gemini_ready:
+            # The caller asked for a specific file, so give them a copy of the input
+            print(f"Already compact: {input_size_mb:.1f}MB, copying to {output_path}")
+            shutil.copyfile(input_path, tmp_output)
+            os.replace(tmp_output, output_path)
+            return str(output_path)
+
+        # Small inputs only need a remux; fall through to a full encode if the copy fails
+        if _within_target(input_path, target_size_mb):
+            print(f"Already within Gemini Pro target: {input_size_mb:.1f}MB → remux only")
+            if _remux(input_path, tmp_output).returncode == 0:
+                os.replace(tmp_output, output_path)
+                return str(output_path)
+            if tmp_output.exists():
+                tmp_output.unlink()
     
-    # Execute compression
-    process = subprocess.run(cmd, text=True)
+        print(f"Compressing for Gemini Pro: {input_size_mb:.1f}MB → optimized")
     
-    if process.returncode == 0:
-        # Move to final location
-        tmp_output.rename(output_path)
+        process = None
+        encoder = detect_hw_encoder()
+        if encoder in _FAILED_HW_ENCODERS:
+            encoder = "libx264"
+        if encoder != "libx264":
+            print(f"Using hardware encoder: {encoder}")
+            bitrate = calculate_bitrate(input_path, target_size_mb) if target_size_mb else None
+            process = _run_hw_encode(input_path, encoder, tmp_output, bitrate, threads)
+            if process.returncode != 0:
+                # Passed the probe but not a real encode; later calls go straight to libx264
+                print(f"Hardware encode with {encoder} failed, falling back to libx264")
+                _FAILED_HW_ENCODERS.add(encoder)
+                if tmp_output.exists():
+                    tmp_output.unlink()
+    
+        if process is None or process.returncode != 0:
+            if target_size_mb:
+                # 2-pass ABR: CRF would ignore -b:v, so a size budget needs real rate control
+                bitrate = calculate_bitrate(input_path, target_size_mb)
+                logfile = output_path.with_name(f"{output_path.stem}_passlog")
+                try:
+                    process = _run_pass1(input_path, bitrate, logfile, threads)
+                    if process.returncode == 0:
+                        process = _run_pass2(input_path, bitrate, logfile, tmp_output, threads)
+                finally:
+                    _remove_pass_logs(logfile)
+            else:
+                # Gemini Pro optimized FFmpeg command
+                cmd = [
+                    "ffmpeg",
+            
+                    # GPU decode when available; frames are handed back for the software filters
+                    "-hwaccel", "auto",
+                    "-i", str(input_path),
+            
+                    # Video: H.264 with aggressive but readable compression
+                    "-c:v", "libx264",
+                    "-crf", "32",                    # Aggressive compression, still readable
+                    "-preset", X264_PRESET,          # Slower presets save ~1-3% at this size for ~10x the time
+                    "-tune", "fastdecode",           # Only Gemini decodes these
+            
+                    *_video_args(threads=threads),
+                    *_AUDIO_ARGS,
+                    *_container_args(tmp_output)
+                ]
         
-        # Show results
-        output_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-        compression_ratio = input_size_mb / output_size_mb if output_size_mb > 0 else 0
-        savings_percent = ((input_size_mb - output_size_mb) / input_size_mb * 100) if input_size_mb > 0 else 0
+                # Execute compression
+                process = run_ffmpeg(cmd)
+    
+        if process.returncode == 0:
+            # Move to final location (atomic, same directory)
+            os.replace(tmp_output, output_path)
         
-        print(f"✅ Gemini Pro ready: {output_size_mb:.1f}MB ({compression_ratio:.1f}x smaller, {savings_percent:.1f}% saved)")
+            # Show results
+            output_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            compression_ratio = input_size_mb / output_size_mb if output_size_mb > 0 else 0
+            savings_percent = ((input_size_mb - output_size_mb) / input_size_mb * 100) if input_size_mb > 0 else 0
         
-        return str(output_path)
-    else:
+            print(f"✅ Gemini Pro ready: {output_size_mb:.1f}MB ({compression_ratio:.1f}x smaller, {savings_percent:.1f}% saved)")
+        
+            return str(output_path)
+        else:
+            # stderr is only captured outside GEMIWRAP_FFMPEG_DEBUG; there ffmpeg already logged it
+            print(f"❌ Compression failed (exit code {process.returncode})" + (f": {process.stderr}" if process.stderr is not None else ""))
+            raise ValueError("Compression failed")
+    finally:
         # Clean up on failure
         if tmp_output.exists():
             tmp_output.unlink()
-        print(f"❌ Compression failed: {process.stderr}")
-        raise ValueError("Compression failed")
 
-def validate_video_tokens(video_path):
-    duration_minutes = video_duration(video_path) // 60
+async def compress_video_async(input_path, output_path=None, target_size_mb=None, threads=0):
+    """
+    Awaitable compress_video, for callers overlapping encodes with uploads on one event loop.
+    """
+    return await asyncio.to_thread(compress_video, input_path, output_path, target_size_mb, threads)
+
+async def split_video_async(video_path, compress=False, target_size_mb=None):
+    """
+    Awaitable split_video; same return value.
+    """
+    return await asyncio.to_thread(split_video, video_path, compress, target_size_mb)
+
+def validate_video_tokens(video_path, duration=None):
+    if duration is None:
+        duration = video_duration(video_path)
+    duration_minutes = duration // 60
     max_chunk = 40
 
     if duration_minutes <= max_chunk:
         return -1  # no split needed
 
-    # Determine the smallest number of equal chunks not exceeding max_chunk
-    for parts in range(2, duration_minutes + 1):
-        chunk_size = math.ceil(duration_minutes / parts)
-        if chunk_size <= max_chunk:
-            return parts  # number of parts to split into
-
-    return -1  # fallback
+    # Smallest number of equal chunks not exceeding max_chunk: ceil(duration / max_chunk)
+    parts = -(-duration_minutes // max_chunk)
+    return parts if parts >= 2 else -1
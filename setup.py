@@ -9,9 +9,7 @@ setup(
 		"pymediainfo",
 		"python-dotenv",
 		"custom_logger @ git+https://github.com/jebin2/custom_logger.git",
-		"ffmpeg-python",
-		"Pillow",
-		"piexif"
+		"Pillow>=9.1"
 	],
 	author="Jebin Einstein",
 	description="A tool for uploading files and interacting with Google's Gemini API.",
@@ -23,5 +21,5 @@ setup(
 		"License :: OSI Approved :: MIT License",  # Choose a license
 		"Operating System :: OS Independent",
 	],
-	python_requires=">=3.7",  # Specify minimum Python version
+	python_requires=">=3.9",  # Specify minimum Python version
 )
\ No newline at end of file
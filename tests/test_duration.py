@@ -0,0 +1,91 @@
+import struct
+
+import pytest
+
+pytest.importorskip("PIL")
+pytest.importorskip("custom_logger")
+
+from gemiwrap.utils import _fast_duration
+
+
+def _box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def _mvhd_v0(timescale, duration):
+    # version + flags, creation/modification time, timescale, duration
+    return _box(b"mvhd", b"\0\0\0\0" + struct.pack(">IIII", 0, 0, timescale, duration) + b"\0" * 80)
+
+def _mvhd_v1(timescale, duration):
+    return _box(b"mvhd", b"\1\0\0\0" + struct.pack(">QQIQ", 0, 0, timescale, duration) + b"\0" * 80)
+
+def _mp4(mvhd):
+    # moov after mdat, as written without faststart
+    return _box(b"ftyp", b"isom\0\0\0\0") + _box(b"mdat", b"x" * 1000) + _box(b"moov", mvhd)
+
+def _element(element_id, payload):
+    # 8 byte size vint keeps the encoding simple
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + b"\x01" + len(payload).to_bytes(7, "big") + payload
+
+def _mkv(*segment_children):
+    header = _element(0x1A45DFA3, _element(0x4286, b"\x01"))
+    # Segment with an unknown size, as live muxers write it
+    return header + b"\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff" + b"".join(segment_children)
+
+def _info(*children):
+    return _element(0x1549A966, b"".join(children))
+
+def _duration(path, data):
+    path.write_bytes(data)
+    return _fast_duration(str(path))
+
+
+def test_mp4_mvhd_v0(tmp_path):
+    assert _duration(tmp_path / "a.mp4", _mp4(_mvhd_v0(1000, 125500))) == 125.5
+
+def test_mp4_mvhd_v1(tmp_path):
+    assert _duration(tmp_path / "a.mov", _mp4(_mvhd_v1(90000, 90000 * 7200))) == 7200
+
+@pytest.mark.parametrize("mvhd", [_mvhd_v0(1000, 0xFFFFFFFF), _mvhd_v1(1000, 0xFFFFFFFFFFFFFFFF), _mvhd_v0(0, 1000)])
+def test_mp4_unknown_duration(tmp_path, mvhd):
+    assert _duration(tmp_path / "a.mp4", _mp4(mvhd)) is None
+
+def test_mp4_truncated(tmp_path):
+    data = _mp4(_mvhd_v1(90000, 90000 * 60))
+    assert _duration(tmp_path / "a.mp4", data[:-90]) is None
+
+def test_mp4_without_moov(tmp_path):
+    assert _duration(tmp_path / "a.mp4", _box(b"ftyp", b"isom\0\0\0\0") + _box(b"mdat", b"x" * 100)) is None
+
+def test_mkv_double_duration(tmp_path):
+    data = _mkv(_element(0x114D9B74, b"seek"), _info(_element(0x2AD7B1, (1000000).to_bytes(3, "big")), _element(0x4489, struct.pack(">d", 61234.0))))
+    assert _duration(tmp_path / "a.mkv", data) == 61.234
+
+def test_mkv_float_duration_and_timecode_scale(tmp_path):
+    data = _mkv(_info(_element(0x4489, struct.pack(">f", 300.0)), _element(0x2AD7B1, (100000000).to_bytes(4, "big"))))
+    assert _duration(tmp_path / "a.webm", data) == 30
+
+def test_mkv_unknown_duration(tmp_path):
+    data = _mkv(_info(_element(0x2AD7B1, (1000000).to_bytes(3, "big"))))
+    assert _duration(tmp_path / "a.mkv", data) is None
+
+def test_mkv_cluster_before_info(tmp_path):
+    data = _mkv(_element(0x1F43B675, b"frames"), _info(_element(0x4489, struct.pack(">d", 1000.0))))
+    assert _duration(tmp_path / "a.mkv", data) is None
+
+def test_mkv_truncated(tmp_path):
+    data = _mkv(_info(_element(0x4489, struct.pack(">d", 61234.0))))
+    assert _duration(tmp_path / "a.mkv", data[:-4]) is None
+
+@pytest.mark.parametrize("data", [b"\x1a\x45\xdf\xa3", b"\x1a\x45\xdf\xa3\x00"])
+def test_mkv_truncated_ebml_header_size(tmp_path, data):
+    assert _duration(tmp_path / "a.mkv", data) is None
+
+@pytest.mark.parametrize("name", ["a.mp4", "a.mkv"])
+def test_non_matching_input(tmp_path, name):
+    assert _duration(tmp_path / name, b"not a video container at all") is None
+
+def test_mp4_data_in_mkv_file(tmp_path):
+    assert _duration(tmp_path / "a.mkv", _mp4(_mvhd_v0(1000, 125500))) is None
+
+def test_unhandled_extension(tmp_path):
+    assert _duration(tmp_path / "a.avi", _mp4(_mvhd_v0(1000, 125500))) is None
@@ -0,0 +1,113 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("PIL")
+pytest.importorskip("custom_logger")
+pytest.importorskip("google.genai")
+
+from gemiwrap import main
+
+PARTS = 3
+
+
+class FakeBackend:
+    """
+    Shared state behind every fake client: an ordered log of file operations
+    and the sends that should fail with a quota error.
+    """
+    def __init__(self, quota_on_send=None):
+        self.log = []
+        self.sends = 0
+        self.quota_on_send = quota_on_send
+        self.quota_hit = threading.Event()
+
+    def client(self, api_key):
+        return SimpleNamespace(
+            files=FakeFiles(self, api_key),
+            chats=SimpleNamespace(create=lambda model, history=None: FakeChat(self)),
+        )
+
+class FakeFiles:
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+        self.count = 0
+
+    def upload(self, file, config):
+        if file.endswith("part2.mp4") and self.backend.quota_on_send and not self.backend.quota_hit.is_set():
+            # Keep this prefetch in flight until the current send has failed
+            self.backend.quota_hit.wait(5)
+        self.count += 1
+        name = f"{self.key}/{self.count}"
+        self.backend.log.append(("upload", self.key, name))
+        return SimpleNamespace(name=name, display_name=file, uri=name)
+
+    def get(self, name):
+        return SimpleNamespace(name=name, state=SimpleNamespace(name="ACTIVE"))
+
+    def delete(self, name):
+        self.backend.log.append(("delete", self.key, name))
+
+    def list(self):
+        return []
+
+class FakeChat:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def send_message(self, prompt, config):
+        self.backend.sends += 1
+        if self.backend.sends == self.backend.quota_on_send:
+            self.backend.quota_hit.set()
+            raise Exception("429 RESOURCE_EXHAUSTED")
+        return SimpleNamespace(text=f"answer {self.backend.sends}")
+
+
+@pytest.fixture
+def wrapper(monkeypatch):
+    def make(backend):
+        monkeypatch.setenv("GEMINI_API_KEYS", "k1,k2")
+        monkeypatch.setattr(main.genai, "Client", backend.client)
+        monkeypatch.setattr(main, "validate_video_tokens", lambda path: PARTS)
+        monkeypatch.setattr(main, "iter_split_video", lambda path, compress=False: [(f"part{i}.mp4", (0, 1)) for i in range(PARTS)])
+        monkeypatch.setattr(main, "compress_video", lambda path, output_path=None, threads=0: path)
+        return main.GeminiWrapper()
+    return make
+
+def _files(log, op, key):
+    return [name for logged_op, logged_key, name in log if logged_op == op and logged_key == key]
+
+
+def test_each_part_uploaded_and_deleted_once(wrapper):
+    backend = FakeBackend()
+    gemini = wrapper(backend)
+    try:
+        assert gemini.send_message("Describe", file_path="long.mp4") == ["answer 1", "answer 2", "answer 3"]
+    finally:
+        gemini.close()
+
+    uploaded = _files(backend.log, "upload", "k1")
+    assert len(uploaded) == PARTS
+    assert _files(backend.log, "delete", "k1") == uploaded
+
+def test_quota_rotation_deletes_prefetched_uploads_with_old_key(wrapper):
+    backend = FakeBackend(quota_on_send=2)
+    gemini = wrapper(backend)
+    try:
+        assert gemini.send_message("Describe", file_path="long.mp4") == ["answer 1", "answer 3", "answer 4"]
+    finally:
+        gemini.close()
+
+    # Parts 1 and 2 (in flight when the quota hit) were uploaded with k1 and cleaned up there
+    old_uploads = _files(backend.log, "upload", "k1")
+    assert len(old_uploads) == PARTS
+    assert sorted(_files(backend.log, "delete", "k1")) == sorted(old_uploads)
+
+    # ...before anything happened on the new key, which then uploads the rest again
+    last_old = max(i for i, (_, key, _) in enumerate(backend.log) if key == "k1")
+    first_new = min(i for i, (_, key, _) in enumerate(backend.log) if key == "k2")
+    assert last_old < first_new
+    assert len(_files(backend.log, "upload", "k2")) == PARTS - 1
+    assert _files(backend.log, "delete", "k2") == _files(backend.log, "upload", "k2")
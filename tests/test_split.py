@@ -0,0 +1,108 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+pytest.importorskip("PIL")
+pytest.importorskip("custom_logger")
+
+from gemiwrap import utils
+
+DURATION = 3 * 3600
+PARTS = 5
+
+
+class FakePopen:
+    """
+    Stands in for the segment muxer: writes each segment and lists it on stdout,
+    recording the order of events so the test can see when parts were handed out.
+    Like ffmpeg, a segment is only closed after its list entry has been read.
+    """
+    def __init__(self, events, segments):
+        self.events = events
+        self.segments = segments
+        self.returncode = None
+
+    def __call__(self, argv, **kwargs):
+        self.argv = argv
+        self.stdout = self._list(argv[-1])
+        return self
+
+    def _list(self, pattern):
+        for i in range(self.segments):
+            segment = pattern.replace("%03d", f"{i:03d}")
+            with open(segment, "w") as f:
+                f.write("x")
+            self.events.append(f"listed {i}")
+            yield segment.rsplit("/", 1)[-1] + "\n"
+            # Closing it now: it must not have been moved away yet
+            self.events.append(f"closed {i}" if os.path.exists(segment) else f"moved while open {i}")
+
+    def wait(self):
+        self.events.append("exit")
+        self.returncode = 0
+        return 0
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        pass
+
+
+@pytest.fixture
+def video(tmp_path, monkeypatch):
+    monkeypatch.setenv("TEMP_OUTPUT", str(tmp_path / "reuse"))
+    monkeypatch.setattr(utils, "video_duration", lambda path: DURATION)
+    path = tmp_path / "long.mp4"
+    path.write_bytes(b"0" * 10)
+    return path
+
+def _split(monkeypatch, video, segments=PARTS):
+    events = []
+    monkeypatch.setattr(subprocess, "Popen", FakePopen(events, segments))
+    parts = []
+    for part_path, time_range in utils.iter_split_video(video):
+        assert part_path.exists()
+        events.append(f"yield {len(parts)}")
+        parts.append((part_path, time_range))
+    return parts, events
+
+
+def test_part_yielded_only_after_next_entry_or_exit(monkeypatch, video):
+    parts, events = _split(monkeypatch, video)
+
+    assert events == [
+        "listed 0", "closed 0", "listed 1", "yield 0",
+        "closed 1", "listed 2", "yield 1",
+        "closed 2", "listed 3", "yield 2",
+        "closed 3", "listed 4", "yield 3",
+        "closed 4", "exit", "yield 4",
+    ]
+    assert [time_range for _, time_range in parts] == [(i * 2160, (i + 1) * 2160) for i in range(PARTS)]
+    assert not list(video.parent.glob("reuse/long/*_segment_*"))
+
+def test_fewer_segments_last_part_runs_to_end(monkeypatch, video):
+    parts, _ = _split(monkeypatch, video, segments=PARTS - 2)
+
+    assert len(parts) == PARTS - 2
+    assert parts[-1][1] == (4320, DURATION)
+
+def test_manifest_reused(monkeypatch, video):
+    parts, _ = _split(monkeypatch, video)
+    manifest = next(video.parent.glob("reuse/long/*.manifest.json"))
+    assert [entry[0] for entry in json.loads(manifest.read_text())] == [path.name for path, _ in parts]
+
+    def no_ffmpeg(*args, **kwargs):
+        raise AssertionError("ffmpeg should not run when every part exists")
+    monkeypatch.setattr(subprocess, "Popen", no_ffmpeg)
+    assert list(utils.iter_split_video(video)) == parts
+
+def test_manifest_ignored_when_a_part_is_missing(monkeypatch, video):
+    parts, _ = _split(monkeypatch, video)
+    parts[2][0].unlink()
+
+    again, events = _split(monkeypatch, video)
+    assert again == parts
+    assert "listed 0" in events